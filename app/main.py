@@ -1,15 +1,22 @@
 
 import os
+import glob
+import json
+import time
 import tempfile
 import asyncio
+import shutil
 import subprocess
-from typing import Optional
+import contextlib
+from typing import Optional, Sequence
 
+import aiohttp
+from cachetools import TTLCache
 from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.responses import PlainTextResponse
 
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.types import Message, CallbackQuery, FSInputFile, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
@@ -22,42 +29,149 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # ---- User Tracking (SQLite) ----
-import sqlite3
+import aiosqlite
 from datetime import date
 
 DB_PATH = "users.sqlite"
 
-def init_db():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen TEXT, last_seen TEXT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS hits (dt TEXT, user_id INTEGER, PRIMARY KEY (dt, user_id))")
-    con.commit()
-    con.close()
+async def init_db() -> aiosqlite.Connection:
+    """Open the one long-lived connection (kept in app.state.db) and create the tables."""
+    db = await aiosqlite.connect(DB_PATH)
+    # WAL + synchronous=NORMAL: a commit appends to the log without an fsync of the db file
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen TEXT, last_seen TEXT)")
+    await db.execute("CREATE TABLE IF NOT EXISTS hits (dt TEXT, user_id INTEGER, PRIMARY KEY (dt, user_id))")
+    # converted outputs Telegram already stores: (input file_unique_id, action) -> output file_id
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS results (src_unique_id TEXT, action TEXT, out_file_id TEXT, "
+        "PRIMARY KEY (src_unique_id, action)) WITHOUT ROWID"
+    )
+    await db.commit()
+    return db
+
+# Rows written in one transaction every DB_FLUSH_INTERVAL s instead of a commit per update:
+# (day, user_id) seen, and (input file_unique_id, action) -> output file_id results
+PENDING_HITS: set[tuple[str, int]] = set()
+PENDING_RESULTS: dict[tuple[str, str], str] = {}
+DB_FLUSH_INTERVAL = 2
 
 def touch_user(user_id: int):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("INSERT OR IGNORE INTO users(user_id, first_seen, last_seen) VALUES (?, datetime('now'), datetime('now'))", (user_id,))
-    cur.execute("UPDATE users SET last_seen = datetime('now') WHERE user_id = ?", (user_id,))
-    cur.execute("INSERT OR IGNORE INTO hits(dt, user_id) VALUES (?, ?)", (date.today().isoformat(), user_id))
-    con.commit()
-    con.close()
+    PENDING_HITS.add((date.today().isoformat(), user_id))
+
+async def flush_db():
+    if not PENDING_HITS and not PENDING_RESULTS:
+        return
+    hits = list(PENDING_HITS)
+    results = dict(PENDING_RESULTS)
+    PENDING_HITS.clear()
+    PENDING_RESULTS.clear()
+    db = app.state.db
+    try:
+        await db.executemany(
+            "INSERT INTO users(user_id, first_seen, last_seen) VALUES (?, datetime('now'), datetime('now')) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen",
+            {(user_id,) for _, user_id in hits},
+        )
+        await db.executemany("INSERT OR IGNORE INTO hits(dt, user_id) VALUES (?, ?)", hits)
+        await db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            [(*key, out_id) for key, out_id in results.items()],
+        )
+        await db.commit()
+    except BaseException:
+        # keep the batch for the next flush (failure or cancellation mid-write)
+        PENDING_HITS.update(hits)
+        for key, out_id in results.items():
+            PENDING_RESULTS.setdefault(key, out_id)
+        raise
+
+async def flush_db_periodically():
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        try:
+            await flush_db()
+        except Exception as e:
+            print("WARNING: database flush failed:", repr(e))
 
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
 SECRET_TOKEN = os.getenv("SECRET_TOKEN", "")
+# self-hosted Bot API server started with --local; its file dir must be mounted here too
+BOT_API_URL = os.getenv("BOT_API_URL", "")
 MAX_FILE_MB = int(os.getenv("MAX_FILE_MB", "18"))
+MAX_FILE_BYTES = MAX_FILE_MB * 1024 * 1024
+X264_PRESET = os.getenv("X264_PRESET", "ultrafast")
+READ_BUFSIZE = 4 << 20  # per-download socket buffer; bounds memory while streaming
+SMALL_FILE_BYTES = 4 * 1024 * 1024  # at or below this, ff_stream buffers the input in RAM
+UPLOAD_CHUNK = 1 << 20  # FSInputFile read size when streaming results to Telegram
+
+FILE_CACHE_MB = int(os.getenv("FILE_CACHE_MB", "256"))
+
+def _default_work_dir() -> str:
+    # RAM-backed /dev/shm if it can hold the file cache (containers often give it only 64 MB)
+    if os.path.isdir("/dev/shm"):
+        st = os.statvfs("/dev/shm")
+        if st.f_bavail * st.f_frsize >= 2 * FILE_CACHE_MB * 1024 * 1024:
+            return "/dev/shm"
+    return tempfile.gettempdir()
+
+# temp media lives in RAM (tmpfs) when possible; WORK_DIR overrides
+TMP_DIR = os.path.join(os.getenv("WORK_DIR") or _default_work_dir(), "massive_helper")
+os.makedirs(TMP_DIR, exist_ok=True)
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
 # aiogram 3.7+ way to set parse_mode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=True)) if BOT_API_URL else None
+bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+class TTLMemoryStorage(BaseStorage):
+    """In-memory FSM storage where idle users expire.
+
+    MemoryStorage keeps one record per user ever seen for the process lifetime;
+    here each user is one (state, data) entry in a TTLCache, refreshed on every access.
+    """
+
+    def __init__(self, maxsize: int = 100_000, ttl: float = 24 * 3600):
+        self.records = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _record(self, key: StorageKey) -> tuple[Optional[str], dict]:
+        record = self.records.get(key, (None, {}))
+        if record[0] is not None or record[1]:
+            self.records[key] = record  # every access restarts the user's TTL
+        return record
+
+    def _put(self, key: StorageKey, state: Optional[str], data: dict):
+        if state is None and not data:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = (state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._put(key, state.state if isinstance(state, State) else state, self._record(key)[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._record(key)[0]
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher()
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        self._put(key, self._record(key)[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict(self._record(key)[1])
+
+    async def close(self) -> None:
+        self.records.clear()
+
+dp = Dispatcher(storage=TTLMemoryStorage())
 router = Router()
 dp.include_router(router)
 
@@ -65,47 +179,61 @@ app = FastAPI()
 
 # ---- Keyboards ----
 
-def main_kb():
+def inline_kb(*buttons: tuple[str, str]):
+    """One-column inline keyboard from (text, callback_data) pairs."""
     kb = InlineKeyboardBuilder()
-    kb.button(text="🎧 Аудио", callback_data="menu:audio")
-    kb.button(text="🎦 Видео/Кружок", callback_data="menu:video")
+    for text, data in buttons:
+        kb.button(text=text, callback_data=data)
     kb.adjust(1)
     return kb.as_markup()
 
-def main_reply_kb():
-    return ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [KeyboardButton(text="🎦 Видео/Кружок"), KeyboardButton(text="🎧 Аудио")],
-            [KeyboardButton(text="ℹ️ Справка")]
-        ]
-    )
-
-def video_reply_kb():
-    return ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [KeyboardButton(text="🎥 Видео → ⭕ Кружок")],
-            [KeyboardButton(text="⭕ Кружок → 🎥 Видео")],
-            [KeyboardButton(text="⬅ Назад")]
-        ]
-    )
+# inline keyboards are static too: built once at import, shared by every handler
+MAIN_KB = inline_kb(
+    ("🎧 Аудио", "menu:audio"),
+    ("🎦 Видео/Кружок", "menu:video"),
+)
+
+# reply keyboards never change: build once, reuse for every message
+MAIN_REPLY_KB = ReplyKeyboardMarkup(
+    resize_keyboard=True,
+    keyboard=[
+        [KeyboardButton(text="🎦 Видео/Кружок"), KeyboardButton(text="🎧 Аудио")],
+        [KeyboardButton(text="ℹ️ Справка")]
+    ]
+)
+
+VIDEO_REPLY_KB = ReplyKeyboardMarkup(
+    resize_keyboard=True,
+    keyboard=[
+        [KeyboardButton(text="🎥 Видео → ⭕ Кружок")],
+        [KeyboardButton(text="⭕ Кружок → 🎥 Видео")],
+        [KeyboardButton(text="⬅ Назад")]
+    ]
+)
 
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+# user_id -> True for recent subscribers; only positive answers are cached, so a
+# user who just subscribed passes "Проверить" at once
+SUBSCRIBED = TTLCache(maxsize=10000, ttl=300)
+
 async def ensure_subscribed(bot: Bot, user_id: int) -> bool:
+    if user_id in SUBSCRIBED:
+        return True
     try:
         member = await bot.get_chat_member("@mediahelperbottt", user_id)
-        return getattr(member, "status", None) in ("member","administrator","creator")
+        ok = getattr(member, "status", None) in ("member","administrator","creator")
     except Exception:
         return False
+    if ok:
+        SUBSCRIBED[user_id] = True
+    return ok
 
-def subscribe_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подписаться", url="https://t.me/mediahelperbottt")],
-        [InlineKeyboardButton(text="🔄 Проверить", callback_data="check_sub")]
-    ])
+SUBSCRIBE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Подписаться", url="https://t.me/mediahelperbottt")],
+    [InlineKeyboardButton(text="🔄 Проверить", callback_data="check_sub")]
+])
 
 @router.callback_query(F.data == "check_sub")
 async def cb_check_sub(c: CallbackQuery):
@@ -114,43 +242,32 @@ async def cb_check_sub(c: CallbackQuery):
     else:
         await c.answer("Вы ещё не подписались.", show_alert=True)
 
-def audio_reply_kb():
-    return ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [KeyboardButton(text="🎬 Видео → 🔊 Аудио (MP3)")],
-            [KeyboardButton(text="⭕ Кружок → 🔊 Аудио (MP3)")],
-            [KeyboardButton(text="🗣️ Голосовое → 🔊 Аудио (MP3)")],
-            [KeyboardButton(text="🎵 Аудио → 🗣️ Голосовое")],
-            [KeyboardButton(text="🎬/⭕ Видео/Кружок → 🗣️ Голосовое")],
-            [KeyboardButton(text="⬅ Назад")]
-        ]
-    )
-
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🎧 Аудио", callback_data="menu:audio")
-    kb.button(text="🎦 Видео/Кружок", callback_data="menu:video")
-    kb.adjust(1)
-    return kb.as_markup()
-
-def audio_kb():
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🎬 Видео → 🔊 Аудио (MP3)", callback_data="audio:from_video")
-    kb.button(text="⭕ Кружок → 🔊 Аудио (MP3)", callback_data="audio:from_circle")
-    kb.button(text="🗣️ Голосовое → 🔊 Аудио (MP3)", callback_data="audio:from_voice")
-    kb.button(text="🎵 Аудио → 🗣️ Голосовое", callback_data="audio:audio_to_voice")
-    kb.button(text="🎬/⭕ Видео/Кружок → 🗣️ Голосовое", callback_data="audio:media_to_voice")
-    kb.button(text="↩️ Назад", callback_data="menu:back")
-    kb.adjust(1)
-    return kb.as_markup()
-
-def video_kb():
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🎥 Видео → ⭕ Кружок", callback_data="video:to_circle")
-    kb.button(text="⭕ Кружок → 🎥 Видео", callback_data="video:to_video")
-    kb.button(text="↩️ Назад", callback_data="menu:back")
-    kb.adjust(1)
-    return kb.as_markup()
+AUDIO_REPLY_KB = ReplyKeyboardMarkup(
+    resize_keyboard=True,
+    keyboard=[
+        [KeyboardButton(text="🎬 Видео → 🔊 Аудио (MP3)")],
+        [KeyboardButton(text="⭕ Кружок → 🔊 Аудио (MP3)")],
+        [KeyboardButton(text="🗣️ Голосовое → 🔊 Аудио (MP3)")],
+        [KeyboardButton(text="🎵 Аудио → 🗣️ Голосовое")],
+        [KeyboardButton(text="🎬/⭕ Видео/Кружок → 🗣️ Голосовое")],
+        [KeyboardButton(text="⬅ Назад")]
+    ]
+)
+
+AUDIO_KB = inline_kb(
+    ("🎬 Видео → 🔊 Аудио (MP3)", "audio:from_video"),
+    ("⭕ Кружок → 🔊 Аудио (MP3)", "audio:from_circle"),
+    ("🗣️ Голосовое → 🔊 Аудио (MP3)", "audio:from_voice"),
+    ("🎵 Аудио → 🗣️ Голосовое", "audio:audio_to_voice"),
+    ("🎬/⭕ Видео/Кружок → 🗣️ Голосовое", "audio:media_to_voice"),
+    ("↩️ Назад", "menu:back"),
+)
+
+VIDEO_KB = inline_kb(
+    ("🎥 Видео → ⭕ Кружок", "video:to_circle"),
+    ("⭕ Кружок → 🎥 Видео", "video:to_video"),
+    ("↩️ Назад", "menu:back"),
+)
 
 # ---- State ----
 
@@ -172,70 +289,520 @@ async def _send_action_periodically(chat_id: int, action: ChatAction):
     except asyncio.CancelledError:
         pass
 
-async def run_ffmpeg(cmd: list):
-    """Run ffmpeg command in thread executor; raise on non-zero return."""
-    loop = asyncio.get_running_loop()
-    def _run():
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if proc.returncode != 0:
-            raise RuntimeError(proc.stderr[-4000:])
-        return proc
-    return await loop.run_in_executor(None, _run)
+# default: one ffmpeg per core, one encoder thread each; extra jobs wait instead of thrashing.
+# A lower MAX_CONCURRENT_FFMPEG gives each job the spare cores as threads.
+FFMPEG_CONCURRENCY = int(os.getenv("MAX_CONCURRENT_FFMPEG", "0")) or max(1, os.cpu_count() or 2)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+FFMPEG_THREADS = str(max(1, (os.cpu_count() or 1) // FFMPEG_CONCURRENCY))
+# GPU encoders have their own session cap (consumer NVENC: a handful), independent of CPU cores
+HW_ENCODER_SEM = asyncio.Semaphore(int(os.getenv("HW_ENCODER_SESSIONS", "3")))
+# every conversion: quiet, errors only, no progress lines (stderr is kept for the exception message)
+# absolute paths resolved once (no $PATH walk per spawn); bare names if missing, the startup probe reports it
+FFMPEG_BIN = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE_BIN = shutil.which("ffprobe") or "ffprobe"
+FFMPEG_CMD = (FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostats")
+
+async def run_ffmpeg(args: Sequence[str], stdin: Optional[bytes] = None) -> bytes:
+    """Run ffmpeg with args as an asyncio subprocess; return stdout, raise on non-zero return.
+
+    stdin, if given, is fed to ffmpeg (use "-i pipe:0" in args).
+    """
+    cmd = [*FFMPEG_CMD, *args]
+    if stdin is None:
+        cmd.insert(1, "-nostdin")
+    async with FFMPEG_SEM:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        try:
+            out, err = await proc.communicate(stdin)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode("utf-8", "replace")[-4000:])
+    return out
+
+def remove_with_outputs(path: str):
+    """Delete a downloaded file and any <base>.* / <base>_* siblings written next to it."""
+    base = glob.escape(path.rsplit(".", 1)[0])
+    for p in glob.glob(base + ".*") + glob.glob(base + "_*"):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+def remove_in_background(path: str):
+    """remove_with_outputs in the default executor; the event loop doesn't wait for the unlinks."""
+    asyncio.get_running_loop().run_in_executor(None, remove_with_outputs, path)
+
+# file_id -> handlers currently using its local file; the cache must not delete it under them
+PINS: dict[str, int] = {}
+# file_id -> paths dropped from the cache while pinned; deleted when the last pin goes away
+ORPHANS: dict[str, list[str]] = {}
+
+def release_file(file_id: str, path: str):
+    """Delete a file that left the cache now, or after its last user if it is pinned."""
+    if PINS.get(file_id):
+        ORPHANS.setdefault(file_id, []).append(path)
+    else:
+        remove_in_background(path)
 
-async def tg_download_to_temp(file_id: str, suffix: str) -> str:
+@contextlib.contextmanager
+def pinned(file_id: str):
+    """Keep file_id's downloaded file (and outputs next to it) on disk while the block runs."""
+    PINS[file_id] = PINS.get(file_id, 0) + 1
+    try:
+        yield
+    finally:
+        PINS[file_id] -= 1
+        if not PINS[file_id]:
+            del PINS[file_id]
+            for path in ORPHANS.pop(file_id, ()):
+                remove_in_background(path)
+
+class FileCache(TTLCache):
+    """TTLCache of local paths that deletes the files when an entry expires or is evicted.
+
+    Files still pinned by a handler are deleted when it is done with them.
+    """
+
+    def __setitem__(self, key, path):
+        if self.getsizeof(path) > self.maxsize:
+            # bigger than the whole cache: don't cache, it goes away after this use
+            release_file(key, path)
+            return
+        super().__setitem__(key, path)
+
+    def popitem(self):
+        key, path = super().popitem()
+        release_file(key, path)
+        return key, path
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, path in expired:
+            release_file(key, path)
+        return expired
+
+STALE_FILE_AGE = 3600  # cache entries live 10 min, so anything older than this was leaked
+
+def sweep_tmp_dir(max_age: float = STALE_FILE_AGE):
+    """Delete files in TMP_DIR left behind by killed handlers or a previous process."""
+    cutoff = time.time() - max_age
+    with os.scandir(TMP_DIR) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+async def sweep_tmp_dir_periodically():
+    while True:
+        await asyncio.to_thread(sweep_tmp_dir)
+        await asyncio.sleep(STALE_FILE_AGE / 6)
+
+# file_id -> local path of an already downloaded file; bounded by total bytes on disk
+FILE_CACHE = FileCache(maxsize=FILE_CACHE_MB * 1024 * 1024, ttl=600, getsizeof=os.path.getsize)
+
+# file_id -> (url or local path, size); Telegram keeps a file_path valid for at least an hour
+FILE_URLS = TTLCache(maxsize=1024, ttl=50 * 60)
+
+async def tg_file_url(file_id: str) -> tuple[str, Optional[int]]:
+    """Return (download url, file size if known) for a Telegram file_id.
+
+    With a local Bot API server the "url" is an absolute path to the file on disk.
+    """
+    cached = FILE_URLS.get(file_id)
+    if cached:
+        return cached
     f = await bot.get_file(file_id)
     # size validation if known
     size = getattr(f, "file_size", None)
-    if size is not None and size > MAX_FILE_MB * 1024 * 1024:
+    if size is not None and size > MAX_FILE_BYTES:
         raise HTTPException(status_code=400, detail=f"Файл слишком большой: {bytes_to_mb(size)} MB (лимит {MAX_FILE_MB} MB)")
-    fd, path = tempfile.mkstemp(suffix=suffix)
-    os.close(fd)
-    await bot.download(f, destination=path)
+    if os.path.isabs(f.file_path):
+        FILE_URLS[file_id] = f.file_path, size
+    else:
+        FILE_URLS[file_id] = bot.session.api.file_url(bot.token, f.file_path), size
+    return FILE_URLS[file_id]
+
+DOWNLOAD_ATTEMPTS = 3
+
+async def tg_get(url: str) -> aiohttp.ClientResponse:
+    """GET a file from Telegram, retrying 429 (honours Retry-After), 5xx and connection errors.
+
+    Backoff is 1 s, 2 s, ...; the returned response is 2xx and must be used as `async with`.
+    """
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        last = attempt == DOWNLOAD_ATTEMPTS - 1
+        delay = 2 ** attempt
+        try:
+            resp = await app.state.http.get(url)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+        else:
+            if last or (resp.status != 429 and resp.status < 500):
+                resp.raise_for_status()
+                return resp
+            if resp.status == 429:
+                try:
+                    delay = min(float(resp.headers.get("Retry-After", delay)), 30)
+                except ValueError:
+                    pass
+            resp.release()
+        await asyncio.sleep(delay)
+
+# file_id -> running download, so concurrent requests for one file share it
+DOWNLOADS: dict[str, asyncio.Task] = {}
+
+async def tg_download_to_temp(file_id: str, suffix: str) -> str:
+    """Local copy of a Telegram file; call inside `with pinned(file_id)` so it stays put while used."""
+    cached = FILE_CACHE.get(file_id)
+    if cached and os.path.exists(cached):
+        return cached
+    task = DOWNLOADS.get(file_id)
+    if task is None:
+        task = asyncio.create_task(_download_to_temp(file_id, suffix))
+        DOWNLOADS[file_id] = task
+        task.add_done_callback(lambda _: DOWNLOADS.pop(file_id, None))
+    # shield: one caller giving up must not cancel the download for the others
+    return await asyncio.shield(task)
+
+async def _download_to_temp(file_id: str, suffix: str) -> str:
+    url, _ = await tg_file_url(file_id)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=TMP_DIR)
+    if os.path.isabs(url):
+        # local Bot API server: plain copy, no HTTP (outputs are written next to our copy)
+        os.close(fd)
+        await asyncio.to_thread(shutil.copyfile, url, path)
+        FILE_CACHE[file_id] = path
+        return path
+    # shared session from startup: keep-alive to api.telegram.org between downloads
+    loop = asyncio.get_running_loop()
+    # unbuffered: chunks go straight to write(2), no extra copy through a userland buffer
+    with os.fdopen(fd, "wb", buffering=0) as out:
+        async with await tg_get(url) as resp:
+            async for chunk in resp.content.iter_any():
+                # disk write in executor so other updates keep flowing
+                await loop.run_in_executor(None, out.write, chunk)
+    FILE_CACHE[file_id] = path
     return path
 
+async def ff_stream(file_id: str, args: Sequence[str], input_args: Sequence[str] = ()) -> bytes:
+    """Feed the Telegram download straight into ffmpeg stdin; args must write to pipe:1.
+
+    Only for inputs ffmpeg can read without seeking (ogg, mp3, ...), not mp4.
+    input_args go before "-i" (e.g. a hardware device).
+    """
+    with pinned(file_id):
+        cached = FILE_CACHE.get(file_id)
+        if cached and os.path.exists(cached):
+            return await run_ffmpeg([*input_args, "-i", cached, *args])
+    url, size = await tg_file_url(file_id)
+    if os.path.isabs(url):
+        return await run_ffmpeg([*input_args, "-i", url, *args])
+    if size is not None and size <= SMALL_FILE_BYTES:
+        # small (voice) files: buffer in RAM first so the ffmpeg slot isn't held during the download
+        buf = bytearray()
+        async with await tg_get(url) as resp:
+            async for chunk in resp.content.iter_any():
+                buf += chunk
+        return await run_ffmpeg([*input_args, "-i", "pipe:0", *args], stdin=bytes(buf))
+    async with FFMPEG_SEM:
+        proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_CMD, *input_args, "-i", "pipe:0", *args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+        async def feed():
+            try:
+                async with await tg_get(url) as resp:
+                    async for chunk in resp.content.iter_any():
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # ffmpeg exited early; its return code tells why
+            finally:
+                proc.stdin.close()
+
+        try:
+            _, out, err = await asyncio.gather(feed(), proc.stdout.read(), proc.stderr.read())
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+        await proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode("utf-8", "replace")[-4000:])
+    return out
 
-async def ff_video_to_circle(src: str) -> str:
-    """Crop to square for video_note and **preserve audio** (AAC)."""
-    dst = src.rsplit(".", 1)[0] + "_circle.mp4"
-    # 1:1 square, 480x480, keep audio (AAC), 30fps
-    vf = "crop='min(iw,ih)':'min(iw,ih)',scale=480:480:flags=lanczos,fps=30,format=yuv420p"
-    cmd = [
-        "ffmpeg", "-y", "-i", src,
-        "-vf", vf,
-        "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "baseline", "-level", "3.0",
+# ffmpeg stderr when an mp4 read from a pipe needed seeking (index at the end)
+UNSEEKABLE_MP4_ERRORS = ("moov atom not found", "partial file")
+
+async def ff_stream_mp4(file_id: str, args: Sequence[str], input_args: Sequence[str] = ()) -> bytes:
+    """ff_stream for mp4 input, retrying from a temp file if the stream can't be read.
+
+    Telegram mp4s are usually faststart (index first) and stream fine; when the
+    moov atom sits at the end ffmpeg needs to seek, so fall back to a local file.
+    """
+    try:
+        return await ff_stream(file_id, args, input_args)
+    except RuntimeError as e:
+        # anything else (no audio track, broken file, encoder error) would fail the same way again
+        if not any(marker in str(e) for marker in UNSEEKABLE_MP4_ERRORS):
+            raise
+        with pinned(file_id):
+            src = await tg_download_to_temp(file_id, ".mp4")
+            return await run_ffmpeg([*input_args, "-i", src, *args])
+
+
+async def list_encoders() -> set[str]:
+    """Encoder names this ffmpeg build has; empty if ffmpeg is missing or broken."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-hide_banner", "-encoders", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return set()
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        return set()
+    # rows look like " V....D libx264    libx264 H.264 / AVC ..."
+    return {parts[1] for parts in map(str.split, out.decode("utf-8", "replace").splitlines()) if len(parts) > 1}
+
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+async def probe_hw_encoder(listed: set[str]) -> str:
+    """Pick a hardware H.264 encoder that can really encode here; fall back to libx264.
+
+    Being listed in `ffmpeg -encoders` is not enough (no GPU/driver on the host),
+    so each candidate must encode a few test frames.
+    """
+    candidates = {
+        "h264_nvenc": ([], []),
+        "h264_qsv": ([], ["-vf", "format=nv12"]),
+        "h264_videotoolbox": ([], []),
+        "h264_vaapi": (["-vaapi_device", VAAPI_DEVICE], ["-vf", "format=nv12,hwupload"]),
+    }
+    for enc, (pre, vf) in candidates.items():
+        if enc not in listed or (enc == "h264_vaapi" and not os.path.exists(VAAPI_DEVICE)):
+            continue
+        proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_CMD, "-nostdin", *pre,
+            "-f", "lavfi", "-i", "color=s=256x256:d=0.2", *vf, "-c:v", enc, "-f", "null", "-",
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        if await proc.wait() == 0:
+            return enc
+    return "libx264"
+
+async def probe_streams(path: str) -> list:
+    """ffprobe stream list for path; [] if it can't be probed."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFPROBE_BIN, "-v", "error", "-print_format", "json", "-show_streams", path,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return []
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        return []
+    return json.loads(out).get("streams", [])
+
+# ---- ffmpeg argument templates (built once; helpers only add input/output paths) ----
+
+# 1:1 square, 480x480; ",fps=30" is added only for sources faster than 30 fps
+CIRCLE_VF = "crop='min(iw,ih)':'min(iw,ih)',scale=480:480:flags=bilinear"
+# encoder -> (input options, end of the -vf chain, video codec options) for video -> circle
+CIRCLE_VIDEO_ARGS = {
+    "h264_nvenc": ((), ",format=yuv420p", (
+        "-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "28", "-b:v", "0",
+    )),
+    # crop/scale stay on CPU (cheap at 480x480); frames are uploaded for the encode only
+    "h264_qsv": ((), ",format=nv12", (
+        "-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "28",
+    )),
+    "h264_vaapi": (("-vaapi_device", VAAPI_DEVICE), ",format=nv12,hwupload", ("-c:v", "h264_vaapi")),
+    # macOS hosts; -b:v because constant-quality mode is Apple Silicon only
+    "h264_videotoolbox": ((), ",format=yuv420p", ("-c:v", "h264_videotoolbox", "-b:v", "1200k")),
+    "libx264": ((), ",format=yuv420p", (
+        "-c:v", "libx264", "-threads", FFMPEG_THREADS, "-preset", X264_PRESET, "-tune", "fastdecode,zerolatency", "-crf", "28", "-g", "60",
+        "-profile:v", "baseline", "-level", "3.0",
         "-pix_fmt", "yuv420p",
-        "-c:a", "aac", "-b:a", "128k", "-ac", "2", "-ar", "48000",
-        "-movflags", "+faststart",
-        dst
-    ]
-    await run_ffmpeg(cmd)
-    return dst
+    )),
+}
+# keep audio (AAC)
+CIRCLE_AUDIO_ARGS = ("-c:a", "aac", "-b:a", "96k", "-ac", "2", "-ar", "48000", "-movflags", "+faststart")
+# encoder -> (input options, video output options) for circle -> video; input is already 480x480
+CIRCLE_TO_VIDEO_ARGS = {
+    "h264_nvenc": ((), (
+        "-pix_fmt", "yuv420p", "-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "23", "-b:v", "0",
+    )),
+    "h264_qsv": ((), ("-vf", "format=nv12", "-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23")),
+    "h264_vaapi": (("-vaapi_device", VAAPI_DEVICE), ("-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi")),
+    "h264_videotoolbox": ((), ("-pix_fmt", "yuv420p", "-c:v", "h264_videotoolbox", "-b:v", "1500k")),
+    "libx264": ((), ("-c:v", "libx264", "-threads", FFMPEG_THREADS, "-preset", "veryfast", "-pix_fmt", "yuv420p")),
+}
+CIRCLE_TO_VIDEO_AUDIO_ARGS = ("-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart")
+# -map 0:a:0: only the first audio stream is read and decoded, video packets are dropped at the demuxer
+MP3_PIPE_ARGS = ("-map", "0:a:0", "-acodec", "libmp3lame", "-ar", "48000", "-b:a", "128k", "-f", "mp3", "pipe:1")
+# host idle? -> libopus speech preset; the slower compression_level 10 only when there is CPU to spare
+VOICE_PIPE_ARGS = {
+    idle: (
+        "-map", "0:a:0", "-c:a", "libopus", "-application", "voip", "-b:a", "32k", "-vbr", "on",
+        "-compression_level", "10" if idle else "5", "-frame_duration", "60",
+        "-ac", "1", "-ar", "48000", "-f", "ogg", "pipe:1",
+    )
+    for idle in (True, False)
+}
+
+# action -> encoders its ffmpeg command needs (the video ones also need the probed H.264 encoder)
+ACTION_ENCODERS = {
+    "video_to_circle": {"aac"},
+    "circle_to_video": {"aac"},
+    "audio_from_video": {"libmp3lame"},
+    "audio_from_circle": {"libmp3lame"},
+    "audio_from_voice": {"libmp3lame"},
+    "audio_to_voice": {"libopus"},
+    "media_to_voice": {"libopus"},
+}
+
+def encoder_slot():
+    """Hold one hardware encoder session for the duration of an encode; no limit for libx264."""
+    if app.state.video_encoder == "libx264":
+        return contextlib.nullcontext()
+    return HW_ENCODER_SEM
+
+def stream_fps(stream: dict) -> float:
+    """Average frame rate of an ffprobe stream; 0 if unknown."""
+    num, _, den = stream.get("avg_frame_rate", "").partition("/")
+    try:
+        return int(num) / int(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
 
-async def ff_circle_to_video(src: str) -> str:
-    dst = src.rsplit(".", 1)[0] + "_video.mp4"
-    cmd = ["ffmpeg", "-y", "-i", src, "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "128k", dst]
-    await run_ffmpeg(cmd)
-    return dst
+async def ff_video_to_circle(src: str) -> str:
+    """Crop to square for video_note and **preserve audio** (AAC).
 
-async def ff_extract_audio(src: str) -> str:
-    dst = src.rsplit(".", 1)[0] + ".mp3"
-    cmd = ["ffmpeg", "-y", "-i", src, "-vn", "-acodec", "libmp3lame", "-ar", "48000", "-b:a", "128k", dst]
-    await run_ffmpeg(cmd)
+    The output is a fresh temp file per call (jobs for the same cached source must not
+    share it); the caller removes it after sending.
+    """
+    fd, dst = tempfile.mkstemp(suffix="_circle.mp4", dir=TMP_DIR)
+    os.close(fd)
+    try:
+        # already a square H.264/AAC clip that fits a video note: remux only, no encode
+        streams = await probe_streams(src)
+        v = next((st for st in streams if st.get("codec_type") == "video"), {})
+        audio = [st for st in streams if st.get("codec_type") == "audio"]
+        if (
+            v.get("codec_name") == "h264" and v.get("pix_fmt") == "yuv420p"
+            and v.get("width") == v.get("height") and (v.get("width") or 0) <= 640
+            and all(st.get("codec_name") == "aac" for st in audio)
+        ):
+            await run_ffmpeg(["-y", "-i", src, "-c", "copy", "-movflags", "+faststart", dst])
+            return dst
+        input_args, vf_tail, video_args = CIRCLE_VIDEO_ARGS[app.state.video_encoder]
+        # a 24/25/30 fps source needs no frame-rate conversion filter
+        vf = CIRCLE_VF if 0 < stream_fps(v) <= 30.5 else CIRCLE_VF + ",fps=30"
+        async with encoder_slot():
+            await run_ffmpeg(["-y", *input_args, "-i", src, "-vf", vf + vf_tail, *video_args, *CIRCLE_AUDIO_ARGS, dst])
+    except BaseException:
+        remove_in_background(dst)
+        raise
     return dst
 
-async def ff_to_mp3(src: str) -> str:
-    dst = src.rsplit(".", 1)[0] + ".mp3"
-    cmd = ["ffmpeg", "-y", "-i", src, "-vn", "-acodec", "libmp3lame", "-ar", "48000", "-b:a", "128k", dst]
-    await run_ffmpeg(cmd)
-    return dst
+async def ff_circle_to_video(file_id: str) -> str:
+    """Circle -> regular mp4; the input is streamed from Telegram, only the output is a file.
 
-async def ff_to_voice(src: str) -> str:
-    """Any audio -> ogg/opus voice."""
-    dst = src.rsplit(".", 1)[0] + ".ogg"
-    cmd = ["ffmpeg", "-y", "-i", src, "-c:a", "libopus", "-b:a", "64k", "-vbr", "on", "-ac", "1", "-ar", "48000", dst]
-    await run_ffmpeg(cmd)
+    Video notes are H.264/AAC already, so the stream is remuxed first and only
+    re-encoded when the probe of the remuxed file says otherwise.
+    The caller removes the returned file after sending it.
+    """
+    fd, dst = tempfile.mkstemp(suffix="_video.mp4", dir=TMP_DIR)
+    os.close(fd)
+    try:
+        await ff_stream_mp4(file_id, ("-y", "-c", "copy", "-movflags", "+faststart", dst))
+        streams = await probe_streams(dst)
+        # an empty list means the probe failed, not that there is nothing to re-encode
+        has_h264 = any(st.get("codec_type") == "video" and st.get("codec_name") == "h264" for st in streams)
+        if has_h264 and all(st.get("codec_name") in ("h264", "aac") for st in streams):
+            return dst
+        src = dst
+        fd, dst = tempfile.mkstemp(suffix="_video.mp4", dir=TMP_DIR)
+        os.close(fd)
+        try:
+            input_args, video_args = CIRCLE_TO_VIDEO_ARGS[app.state.video_encoder]
+            async with encoder_slot():
+                await run_ffmpeg(["-y", *input_args, "-i", src, *video_args, *CIRCLE_TO_VIDEO_AUDIO_ARGS, dst])
+        finally:
+            remove_in_background(src)
+    except BaseException:
+        remove_in_background(dst)
+        raise
     return dst
 
+def voice_pipe_args() -> tuple:
+    """libopus speech preset for voice messages; spend extra encoder effort only when the host is idle."""
+    idle = os.getloadavg()[0] < (os.cpu_count() or 1) / 2
+    return VOICE_PIPE_ARGS[idle]
+
+async def ff_to_voice(src: str) -> bytes:
+    """Any audio -> ogg/opus voice, returned straight from ffmpeg stdout."""
+    return await run_ffmpeg(["-i", src, *voice_pipe_args()])
+
+# (input file_unique_id, action) -> file_id of the converted file Telegram already stores.
+# Hot entries live here; the results table keeps all of them across restarts.
+RESULT_CACHE = TTLCache(maxsize=4096, ttl=24 * 3600)
+RESULT_SENDERS = {
+    "video_to_circle": "answer_video_note",
+    "circle_to_video": "answer_video",
+    "audio_from_video": "answer_audio",
+    "audio_from_circle": "answer_audio",
+    "audio_from_voice": "answer_audio",
+    "audio_to_voice": "answer_voice",
+    "media_to_voice": "answer_voice",
+}
+
+async def upload_with_action(message: Message, act: ChatAction, send) -> Message:
+    """Await the send coroutine while the upload status goes out in parallel (one round-trip, not two).
+
+    "Готово ✅" stays sequential after this: it must not appear before the file.
+    """
+    _, sent = await asyncio.gather(bot.send_chat_action(message.chat.id, action=act), send)
+    return sent
+
+async def cached_result(key: tuple) -> Optional[str]:
+    out_id = RESULT_CACHE.get(key)
+    if out_id is None:
+        # best effort: a broken results table only costs a re-conversion
+        try:
+            async with app.state.db.execute(
+                "SELECT out_file_id FROM results WHERE src_unique_id = ? AND action = ?", key,
+            ) as cur:
+                row = await cur.fetchone()
+        except Exception as e:
+            print("WARNING: result cache lookup failed:", repr(e))
+            return None
+        if row:
+            out_id = RESULT_CACHE[key] = row[0]
+    return out_id
+
+def remember_result(key: tuple, sent: Message):
+    # the file is already delivered; persisting is batched into flush_db and never fails the handler
+    out = sent.video_note or sent.video or sent.audio or sent.voice
+    if out:
+        RESULT_CACHE[key] = out.file_id
+        PENDING_RESULTS[key] = out.file_id
+
 # ---- Handlers ----
 
 
@@ -256,7 +823,7 @@ async def on_start(message: Message, state: FSMContext):
         
         "Выбери нужный раздел в меню ниже:"
     )
-    await message.answer(text, reply_markup=main_reply_kb())
+    await message.answer(text, reply_markup=MAIN_REPLY_KB)
 
 
 @router.callback_query(F.data == "menu:audio")
@@ -264,7 +831,7 @@ async def cb_audio(c: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.waiting_input)
     await state.update_data(action=None)  # clear
     try:
-        await c.message.edit_text("🎧 Аудио: выбери функцию", reply_markup=audio_kb())
+        await c.message.edit_text("🎧 Аудио: выбери функцию", reply_markup=AUDIO_KB)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await c.answer("Вы уже в этом меню", show_alert=False)
@@ -278,7 +845,7 @@ async def cb_video(c: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.waiting_input)
     await state.update_data(action=None)
     try:
-        await c.message.edit_text("🎦 Видео / Кружок: выбери функцию", reply_markup=video_kb())
+        await c.message.edit_text("🎦 Видео / Кружок: выбери функцию", reply_markup=VIDEO_KB)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await c.answer("Вы уже в этом меню", show_alert=False)
@@ -291,7 +858,7 @@ async def cb_video(c: CallbackQuery, state: FSMContext):
 async def cb_back(c: CallbackQuery, state: FSMContext):
     await state.clear()
     try:
-        await c.message.edit_text("Выбери действие:", reply_markup=main_kb())
+        await c.message.edit_text("Выбери действие:", reply_markup=MAIN_KB)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await c.answer("Вы уже в этом меню", show_alert=False)
@@ -302,29 +869,30 @@ async def cb_back(c: CallbackQuery, state: FSMContext):
 
 # Audio actions selection
 
-@router.callback_query(F.data.startswith("audio:"))
+# Functions (inline keyboard): callback data -> (action, prompt)
+AUDIO_CALLBACKS = {
+    "audio:from_video": ("audio_from_video", "🔊 **Достаю звук из видео**\nПришли видео 🎬 — верну отдельно аудио (mp3)."),
+    "audio:from_circle": ("audio_from_circle", "🔊 **Достаю звук из кружка**\nПришли кружок ⭕ — верну аудио (mp3)."),
+    "audio:from_voice": ("audio_from_voice", "🔊 **Голосовое → аудио**\nПришли голосовое 🗣️ — преобразую в .ogg/.mp3."),
+    "audio:audio_to_voice": ("audio_to_voice", "🗣️ **Аудиофайл → голосовое**\nПришли аудиофайл (mp3/wav/ogg) — сделаю голосовое сообщение (ogg/opus)."),
+    "audio:media_to_voice": ("media_to_voice", "🗣️ **Видео/кружок → голосовое**\nПришли видео 🎬 или кружок ⭕ — сделаю голосовое (ogg/opus)."),
+}
+
+VIDEO_CALLBACKS = {
+    "video:to_circle": ("video_to_circle", "⭕ **Видео → Кружок**\nПришли обычное видео 🎥 — я сделаю из него кружок. Видео должно быть не дольше ~60 сек и не больше лимита файла.\n\nГотов? Отправляй файл."),
+    "video:to_video": ("circle_to_video", "🎥 **Кружок → Видео**\nПришли кружок ⭕ — верну его в обычный видеофайл с квадратной картинкой.\n\nГотов? Отправляй файл."),
+}
+
+@router.callback_query(F.data.in_(AUDIO_CALLBACKS))
 async def select_audio(c: CallbackQuery, state: FSMContext):
     if not await ensure_subscribed(bot, c.from_user.id):
-        await c.message.edit_text('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
+        await c.message.edit_text('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=SUBSCRIBE_KB)
         return
-    m = {
-        "audio:from_video": "audio_from_video",
-        "audio:from_circle": "audio_from_circle",
-        "audio:from_voice": "audio_from_voice",
-        "audio:audio_to_voice": "audio_to_voice",
-        "audio:media_to_voice": "media_to_voice",
-    }[c.data]
-    await state.update_data(action=m)
-    prompts = {
-        "audio_from_video": "🔊 **Достаю звук из видео**\nПришли видео 🎬 — верну отдельно аудио (mp3).",
-        "audio_from_circle": "🔊 **Достаю звук из кружка**\nПришли кружок ⭕ — верну аудио (mp3).",
-        "audio_from_voice": "🔊 **Голосовое → аудио**\nПришли голосовое 🗣️ — преобразую в .ogg/.mp3.",
-        "audio_to_voice": "🗣️ **Аудиофайл → голосовое**\nПришли аудиофайл (mp3/wav/ogg) — сделаю голосовое сообщение (ogg/opus).",
-        "media_to_voice": "🗣️ **Видео/кружок → голосовое**\nПришли видео 🎬 или кружок ⭕ — сделаю голосовое (ogg/opus).",
-    }
+    action, prompt = AUDIO_CALLBACKS[c.data]
+    await state.update_data(action=action)
     await state.set_state(Flow.waiting_input)
     try:
-        await c.message.edit_text(prompts[m], reply_markup=audio_kb(), parse_mode="Markdown")
+        await c.message.edit_text(prompt, reply_markup=AUDIO_KB, parse_mode="Markdown")
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await c.answer("Вы уже в этом меню", show_alert=False)
@@ -336,22 +904,15 @@ async def select_audio(c: CallbackQuery, state: FSMContext):
 
 # Video actions selection
 
-@router.callback_query(F.data.startswith("video:"))
+@router.callback_query(F.data.in_(VIDEO_CALLBACKS))
 async def select_video(c: CallbackQuery, state: FSMContext):
     if not await ensure_subscribed(bot, c.from_user.id):
-        await c.message.edit_text('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
+        await c.message.edit_text('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=SUBSCRIBE_KB)
         return
-    m = {
-        "video:to_circle": "video_to_circle",
-        "video:to_video": "circle_to_video",
-    }[c.data]
-    await state.update_data(action=m)
-    prompts = {
-        "video_to_circle": "⭕ **Видео → Кружок**\nПришли обычное видео 🎥 — я сделаю из него кружок. Видео должно быть не дольше ~60 сек и не больше лимита файла.\n\nГотов? Отправляй файл.",
-        "circle_to_video": "🎥 **Кружок → Видео**\nПришли кружок ⭕ — верну его в обычный видеофайл с квадратной картинкой.\n\nГотов? Отправляй файл.",
-    }
+    action, prompt = VIDEO_CALLBACKS[c.data]
+    await state.update_data(action=action)
     try:
-        await c.message.edit_text(prompts[m], reply_markup=video_kb(), parse_mode="Markdown")
+        await c.message.edit_text(prompt, reply_markup=VIDEO_KB, parse_mode="Markdown")
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await c.answer("Вы уже в этом меню", show_alert=False)
@@ -364,90 +925,55 @@ async def select_video(c: CallbackQuery, state: FSMContext):
 
 # ---- Reply Keyboard handlers ----
 
-@router.message(F.text == "🎦 Видео/Кружок")
-async def on_text_menu_video(message: Message, state: FSMContext):
-    await state.set_state(Flow.waiting_input)
-    await state.update_data(action=None)
-    await message.answer("🎦 Видео / Кружок: выбери функцию на клавиатуре ⤵️", reply_markup=video_reply_kb())
+# Sections (reply keyboard): button text -> (prompt, keyboard)
+TEXT_MENUS = {
+    "🎦 Видео/Кружок": ("🎦 Видео / Кружок: выбери функцию на клавиатуре ⤵️", VIDEO_REPLY_KB),
+    "🎧 Аудио": ("🎧 Аудио: выбери функцию на клавиатуре ⤵️", AUDIO_REPLY_KB),
+}
 
-@router.message(F.text == "🎧 Аудио")
-async def on_text_menu_audio(message: Message, state: FSMContext):
+@router.message(F.text.in_(TEXT_MENUS))
+async def on_text_menu(message: Message, state: FSMContext):
     await state.set_state(Flow.waiting_input)
     await state.update_data(action=None)
-    await message.answer("🎧 Аудио: выбери функцию на клавиатуре ⤵️", reply_markup=audio_reply_kb())
+    prompt, kb = TEXT_MENUS[message.text]
+    await message.answer(prompt, reply_markup=kb)
 
 @router.message(F.text == "⬅ Назад")
 async def on_text_back(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer("Главное меню:", reply_markup=main_reply_kb())
-
-# Functions (reply keyboard)
-@router.message(F.text == "🎥 Видео → ⭕ Кружок")
-async def on_text_v_to_circle(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="video_to_circle")
-    await message.answer("Пришли видео 🎥 — сделаю **кружок** ⭕.", reply_markup=video_reply_kb())
-
-@router.message(F.text == "⭕ Кружок → 🎥 Видео")
-async def on_text_circle_to_v(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="circle_to_video")
-    await message.answer("Пришли кружок ⭕ — верну обычное **видео** 🎥.", reply_markup=video_reply_kb())
-
-@router.message(F.text == "🎬 Видео → 🔊 Аудио (MP3)")
-async def on_text_a_from_video(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="audio_from_video")
-    await message.answer("Пришли видео 🎬 — достану **аудио (MP3)** 🔊.", reply_markup=audio_reply_kb())
-
-@router.message(F.text == "⭕ Кружок → 🔊 Аудио (MP3)")
-async def on_text_a_from_circle(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="audio_from_circle")
-    await message.answer("Пришли кружок ⭕ — достану **аудио (MP3)** 🔊.", reply_markup=audio_reply_kb())
-
-@router.message(F.text == "🗣️ Голосовое → 🔊 Аудио (MP3)")
-async def on_text_a_from_voice(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="audio_from_voice")
-    await message.answer("Пришли голосовое 🗣️ — сделаю **аудио (MP3)** 🔊.", reply_markup=audio_reply_kb())
-
-@router.message(F.text == "🎵 Аудио → 🗣️ Голосовое")
-async def on_text_audio_to_voice(message: Message, state: FSMContext):
-    if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
-        return
-    await state.update_data(action="audio_to_voice")
-    await message.answer("Пришли аудиофайл 🎵 — верну **голосовое** 🗣️ (ogg/opus).", reply_markup=audio_reply_kb())
-
-@router.message(F.text == "🎬/⭕ Видео/Кружок → 🗣️ Голосовое")
-async def on_text_media_to_voice(message: Message, state: FSMContext):
+    await message.answer("Главное меню:", reply_markup=MAIN_REPLY_KB)
+
+# Functions (reply keyboard): button text -> (action, prompt, keyboard)
+TEXT_ACTIONS = {
+    "🎥 Видео → ⭕ Кружок": ("video_to_circle", "Пришли видео 🎥 — сделаю **кружок** ⭕.", VIDEO_REPLY_KB),
+    "⭕ Кружок → 🎥 Видео": ("circle_to_video", "Пришли кружок ⭕ — верну обычное **видео** 🎥.", VIDEO_REPLY_KB),
+    "🎬 Видео → 🔊 Аудио (MP3)": ("audio_from_video", "Пришли видео 🎬 — достану **аудио (MP3)** 🔊.", AUDIO_REPLY_KB),
+    "⭕ Кружок → 🔊 Аудио (MP3)": ("audio_from_circle", "Пришли кружок ⭕ — достану **аудио (MP3)** 🔊.", AUDIO_REPLY_KB),
+    "🗣️ Голосовое → 🔊 Аудио (MP3)": ("audio_from_voice", "Пришли голосовое 🗣️ — сделаю **аудио (MP3)** 🔊.", AUDIO_REPLY_KB),
+    "🎵 Аудио → 🗣️ Голосовое": ("audio_to_voice", "Пришли аудиофайл 🎵 — верну **голосовое** 🗣️ (ogg/opus).", AUDIO_REPLY_KB),
+    "🎬/⭕ Видео/Кружок → 🗣️ Голосовое": ("media_to_voice", "Пришли **видео** 🎬 или **кружок** ⭕ — сделаю **голосовое** 🗣️.", AUDIO_REPLY_KB),
+}
+
+@router.message(F.text.in_(TEXT_ACTIONS))
+async def on_text_action(message: Message, state: FSMContext):
     if not await ensure_subscribed(bot, message.from_user.id):
-        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=subscribe_keyboard())
+        await message.answer('Чтобы пользоваться этой функцией, подпишитесь на канал:', reply_markup=SUBSCRIBE_KB)
         return
-    await state.update_data(action="media_to_voice")
-    await message.answer("Пришли **видео** 🎬 или **кружок** ⭕ — сделаю **голосовое** 🗣️.", reply_markup=audio_reply_kb())
+    action, prompt, kb = TEXT_ACTIONS[message.text]
+    await state.update_data(action=action)
+    await message.answer(prompt, reply_markup=kb)
 
 
 @router.message(F.text == "/stats")
 async def stats_cmd(message: Message):
     if message.from_user.username != "Maksimqax":
         return
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    total = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    today = cur.execute("SELECT COUNT(*) FROM hits WHERE dt = ?", (date.today().isoformat(),)).fetchone()[0]
-    con.close()
+    await flush_db()
+    db = app.state.db
+    async with db.execute("SELECT COUNT(*) FROM users") as cur:
+        total = (await cur.fetchone())[0]
+    async with db.execute("SELECT COUNT(*) FROM hits WHERE dt = ?", (date.today().isoformat(),)) as cur:
+        today = (await cur.fetchone())[0]
     await message.answer(f"👥 Всего пользователей: {total}\n📅 Сегодня активных: {today}")
 
 # --- Content handlers (process according to action) ---
@@ -460,6 +986,23 @@ async def process_media(message: Message, state: FSMContext):
     action = data.get("action")
     if not action:
         return
+    if action not in app.state.ready_actions:
+        await message.answer("❌ Конвертация временно недоступна.")
+        return
+    # the update already carries file_size: reject big files without a get_file call
+    media = message.video or message.video_note or message.voice or message.audio
+    size = media.file_size
+    if size is not None and size > MAX_FILE_BYTES:
+        await message.answer(f"⚠️ Файл слишком большой: {bytes_to_mb(size)} MB (лимит {MAX_FILE_MB} MB)")
+        return
+    # same input converted the same way before: resend Telegram's copy, skip download/ffmpeg/upload
+    # file_unique_id: the same clip forwarded by another user has a different file_id
+    key = (media.file_unique_id, action)
+    cached_id = await cached_result(key)
+    if cached_id:
+        await getattr(message, RESULT_SENDERS[action])(cached_id)
+        await message.answer("Готово ✅")
+        return
 
     async def action_loop(act: ChatAction):
         task = asyncio.create_task(_send_action_periodically(message.chat.id, act))
@@ -470,12 +1013,16 @@ async def process_media(message: Message, state: FSMContext):
         if action == "video_to_circle" and message.video:
             act = await action_loop(ChatAction.RECORD_VIDEO_NOTE)
             try:
-                src = await tg_download_to_temp(message.video.file_id, ".mp4")
-                dst = await ff_video_to_circle(src)
+                with pinned(message.video.file_id):
+                    src = await tg_download_to_temp(message.video.file_id, ".mp4")
+                    dst = await ff_video_to_circle(src)
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_VIDEO_NOTE)
-            await message.answer_video_note(FSInputFile(dst))
+            try:
+                sent = await upload_with_action(message, ChatAction.UPLOAD_VIDEO_NOTE, message.answer_video_note(FSInputFile(dst, chunk_size=UPLOAD_CHUNK)))
+            finally:
+                remove_in_background(dst)
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -483,12 +1030,14 @@ async def process_media(message: Message, state: FSMContext):
         if action == "circle_to_video" and message.video_note:
             act = await action_loop(ChatAction.RECORD_VIDEO)
             try:
-                src = await tg_download_to_temp(message.video_note.file_id, ".mp4")
-                dst = await ff_circle_to_video(src)
+                dst = await ff_circle_to_video(message.video_note.file_id)
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_VIDEO)
-            await message.answer_video(FSInputFile(dst))
+            try:
+                sent = await upload_with_action(message, ChatAction.UPLOAD_VIDEO, message.answer_video(FSInputFile(dst, chunk_size=UPLOAD_CHUNK)))
+            finally:
+                remove_in_background(dst)
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -496,12 +1045,11 @@ async def process_media(message: Message, state: FSMContext):
         if action == "audio_from_video" and message.video:
             act = await action_loop(ChatAction.RECORD_VOICE)
             try:
-                src = await tg_download_to_temp(message.video.file_id, ".mp4")
-                dst = await ff_extract_audio(src)
+                data = await ff_stream_mp4(message.video.file_id, MP3_PIPE_ARGS)
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_DOCUMENT)
-            await message.answer_audio(FSInputFile(dst))
+            sent = await upload_with_action(message, ChatAction.UPLOAD_DOCUMENT, message.answer_audio(BufferedInputFile(data, filename="audio.mp3")))
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -509,12 +1057,11 @@ async def process_media(message: Message, state: FSMContext):
         if action == "audio_from_circle" and message.video_note:
             act = await action_loop(ChatAction.RECORD_VOICE)
             try:
-                src = await tg_download_to_temp(message.video_note.file_id, ".mp4")
-                dst = await ff_extract_audio(src)
+                data = await ff_stream_mp4(message.video_note.file_id, MP3_PIPE_ARGS)
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_DOCUMENT)
-            await message.answer_audio(FSInputFile(dst))
+            sent = await upload_with_action(message, ChatAction.UPLOAD_DOCUMENT, message.answer_audio(BufferedInputFile(data, filename="audio.mp3")))
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -522,12 +1069,11 @@ async def process_media(message: Message, state: FSMContext):
         if action == "audio_from_voice" and message.voice:
             act = await action_loop(ChatAction.RECORD_VOICE)
             try:
-                src = await tg_download_to_temp(message.voice.file_id, ".ogg")
-                dst = await ff_to_mp3(src)
+                data = await ff_stream(message.voice.file_id, MP3_PIPE_ARGS)
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_DOCUMENT)
-            await message.answer_audio(FSInputFile(dst))
+            sent = await upload_with_action(message, ChatAction.UPLOAD_DOCUMENT, message.answer_audio(BufferedInputFile(data, filename="audio.mp3")))
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -536,13 +1082,18 @@ async def process_media(message: Message, state: FSMContext):
             act = await action_loop(ChatAction.RECORD_VOICE)
             try:
                 file_id = message.audio.file_id
-                suffix = ".mp3" if (message.audio.file_name or "").endswith(".mp3") else ".ogg"
-                src = await tg_download_to_temp(file_id, suffix)
-                dst = await ff_to_voice(src)
+                mime = message.audio.mime_type or ""
+                if "mp4" in mime or "m4a" in mime:
+                    # mp4/m4a may keep the index at the end: ffmpeg needs a seekable file
+                    with pinned(file_id):
+                        src = await tg_download_to_temp(file_id, ".m4a")
+                        data = await ff_to_voice(src)
+                else:
+                    data = await ff_stream(file_id, voice_pipe_args())
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_VOICE)
-            await message.answer_voice(FSInputFile(dst))
+            sent = await upload_with_action(message, ChatAction.UPLOAD_VOICE, message.answer_voice(BufferedInputFile(data, filename="voice.ogg")))
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -550,17 +1101,12 @@ async def process_media(message: Message, state: FSMContext):
         if action == "media_to_voice" and (message.video or message.video_note):
             act = await action_loop(ChatAction.RECORD_VOICE)
             try:
-                if message.video:
-                    file_id, suffix = message.video.file_id, ".mp4"
-                else:
-                    file_id, suffix = message.video_note.file_id, ".mp4"
-                src = await tg_download_to_temp(file_id, suffix)
-                tmp_audio = await ff_extract_audio(src)
-                dst = await ff_to_voice(tmp_audio)
+                media = message.video or message.video_note
+                data = await ff_stream_mp4(media.file_id, voice_pipe_args())
             finally:
                 act.cancel()
-            await bot.send_chat_action(message.chat.id, action=ChatAction.UPLOAD_VOICE)
-            await message.answer_voice(FSInputFile(dst))
+            sent = await upload_with_action(message, ChatAction.UPLOAD_VOICE, message.answer_voice(BufferedInputFile(data, filename="voice.ogg")))
+            remember_result(key, sent)
             await message.answer("Готово ✅")
             return
 
@@ -586,6 +1132,13 @@ async def health():
 async def health():
     return "ok"
 
+# strong refs to running update tasks so they are not garbage-collected
+UPDATE_TASKS: set[asyncio.Task] = set()
+# beyond this many in-flight updates answer 503 so Telegram redelivers later
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1000"))
+# seconds a shutdown waits for acked updates to finish (Render allows 30 s before SIGKILL)
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "25"))
+
 @app.post("/")
 async def webhook(request: Request):
     # Secret-token protection (optional)
@@ -594,19 +1147,53 @@ async def webhook(request: Request):
         if rtoken != SECRET_TOKEN:
             raise HTTPException(status_code=403, detail="Bad secret token")
 
-    data = await request.json()
-    # Parse dict -> Update object
-    update = Update.model_validate(data)
+    if len(UPDATE_TASKS) >= MAX_PENDING_UPDATES:
+        return Response(status_code=503)
+
+    # Parse raw JSON bytes -> Update object in one pass (pydantic-core)
+    update = Update.model_validate_json(await request.body())
 
-    # Feed to aiogram
-    await dp.feed_update(bot, update)
+    # Feed to aiogram in the background: ack Telegram now, convert afterwards
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    UPDATE_TASKS.add(task)
+    task.add_done_callback(UPDATE_TASKS.discard)
     return Response(status_code=200)
 
 # ---- Startup: set webhook ----
 
 @app.on_event("startup")
 async def on_startup():
-    init_db()
+    app.state.db = await init_db()
+    app.state.db_flush = asyncio.create_task(flush_db_periodically())
+    app.state.tmp_gc = asyncio.create_task(sweep_tmp_dir_periodically())
+    app.state.http = aiohttp.ClientSession(
+        # fail fast on a dead connect or a stalled read instead of waiting out the total
+        timeout=aiohttp.ClientTimeout(total=600, sock_connect=10, sock_read=60),
+        # keep idle connections 75 s (default 15 s) so sparse traffic still reuses TLS
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=75),
+        read_bufsize=READ_BUFSIZE,
+    )
+    # warm DNS + TLS to the file host so the first download skips the handshake
+    try:
+        async with app.state.http.head(bot.session.api.file_url(bot.token, "")):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("WARNING: could not pre-connect to Telegram:", repr(e))
+    # check ffmpeg and its encoders once here instead of failing after every download
+    encoders = await list_encoders()
+    if not encoders:
+        print("WARNING: ffmpeg is not available; conversions are disabled.")
+        app.state.video_encoder = "libx264"
+    else:
+        app.state.video_encoder = await probe_hw_encoder(encoders)
+        print("H.264 encoder:", app.state.video_encoder)
+    needs = dict(ACTION_ENCODERS)
+    for action in ("video_to_circle", "circle_to_video"):
+        needs[action] = needs[action] | {app.state.video_encoder}
+    app.state.ready_actions = {action for action, need in needs.items() if need <= encoders}
+    for action in needs.keys() - app.state.ready_actions:
+        if encoders:
+            print(f"WARNING: {action} disabled, ffmpeg lacks:", ", ".join(sorted(needs[action] - encoders)))
     if WEBHOOK_URL:
         await bot.set_webhook(url=WEBHOOK_URL, secret_token=(SECRET_TOKEN or None))
     else:
@@ -614,4 +1201,18 @@ async def on_startup():
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # updates were already acked, so Telegram won't redeliver them: let them finish
+    # while the session/db they use are still open, then cancel the stragglers
+    if UPDATE_TASKS:
+        _, pending = await asyncio.wait(set(UPDATE_TASKS), timeout=SHUTDOWN_GRACE)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    app.state.tmp_gc.cancel()
+    await app.state.http.close()
+    app.state.db_flush.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.db_flush
+    await flush_db()
+    await app.state.db.close()
     await bot.session.close()
\ No newline at end of file
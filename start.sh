@@ -2,4 +2,6 @@
 set -e
 # Render provides PORT; default to 10000 for local
 PORT=${PORT:-10000}
-exec uvicorn app.main:app --host 0.0.0.0 --port $PORT
+# uvloop + httptools ship with uvicorn[standard]; name them so a missing one fails loudly.
+# Single worker on purpose: FSM state and caches live in process memory.
+exec uvicorn app.main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools